@@ -1,9 +1,15 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import Optional
-from jose import JWTError, jwt
+import hashlib
+import os
+import re
+import threading
+import time
+import jwt
 import bcrypt
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from . import models, database
 
@@ -11,29 +17,113 @@ from . import models, database
 SECRET_KEY = "supersecretkey_docrack_local"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 # 24 hours
+# Only send the session cookie over HTTPS; off by default since the app is often served over plain HTTP
+COOKIE_SECURE = os.getenv("COOKIE_SECURE", "false").lower() in ("1", "true", "yes")
+# bcrypt work factor, each +1 doubles the hashing cost
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Optional pre-computed bcrypt hash for the default admin, skips hashing at startup
+DEFAULT_ADMIN_HASH = os.getenv("DEFAULT_ADMIN_BCRYPT")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Cache of already validated tokens: raw token -> (exp timestamp, user id)
+# Entries live until the token's own "exp", so hits skip jwt.decode entirely.
+# Failed validations are never cached.
+TOKEN_CACHE_MAXSIZE = 10000
+TOKEN_CACHE_SWEEP_INTERVAL = 60 # seconds between scans for expired entries
+_token_cache: dict[str, tuple[float, int]] = {}
+_token_cache_lock = threading.Lock()
+_token_cache_next_sweep = 0.0
+
+def _get_cached_token(token: str) -> Optional[int]:
+    with _token_cache_lock:
+        hit = _token_cache.get(token)
+        if hit is None:
+            return None
+        exp, user_id = hit
+        if exp <= time.time():
+            del _token_cache[token]
+            return None
+        return user_id
+
+def _cache_token(token: str, exp: float, user_id: int):
+    global _token_cache_next_sweep
+    with _token_cache_lock:
+        now = time.time()
+        # Expired entries are swept at most once per interval, so a full cache
+        # of live tokens does not pay an O(n) scan on every insert
+        if now >= _token_cache_next_sweep:
+            for key in [k for k, (e, _) in _token_cache.items() if e <= now]:
+                del _token_cache[key]
+            _token_cache_next_sweep = now + TOKEN_CACHE_SWEEP_INTERVAL
+        # Still full: evict the oldest entry (dicts keep insertion order)
+        while len(_token_cache) >= TOKEN_CACHE_MAXSIZE:
+            del _token_cache[next(iter(_token_cache))]
+        _token_cache[token] = (exp, user_id)
+
+# Hash checked when the user does not exist, so the login path always pays
+# the bcrypt cost and does not leak valid usernames through timing
+DUMMY_HASH = bcrypt.hashpw(b"x", bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+# Short lived cache of successful verifications: sha256(password + hash) -> expiry
+# Repeated logins with the same credentials skip the bcrypt work. Only
+# successes are cached, and the key changes whenever the stored hash does.
+PASSWORD_CACHE_MAXSIZE = 1024
+PASSWORD_CACHE_TTL = 60
+_password_cache: dict[bytes, float] = {}
+_password_cache_lock = threading.Lock()
+
 def verify_password(plain_password, hashed_password):
     # Ensure bytes
     if isinstance(hashed_password, str):
         hashed_password = hashed_password.encode('utf-8')
     if isinstance(plain_password, str):
         plain_password = plain_password.encode('utf-8')
-        
-    return bcrypt.checkpw(plain_password, hashed_password)
+
+    # Never cache the dummy hash, a fast answer there would reveal unknown users
+    cacheable = hashed_password != DUMMY_HASH
+    key = hashlib.sha256(plain_password + b"\0" + hashed_password).digest()
+    if cacheable:
+        with _password_cache_lock:
+            expires = _password_cache.get(key)
+            if expires is not None:
+                if expires > time.time():
+                    return True
+                del _password_cache[key]
+
+    verified = bcrypt.checkpw(plain_password, hashed_password)
+    if verified and cacheable:
+        with _password_cache_lock:
+            while len(_password_cache) >= PASSWORD_CACHE_MAXSIZE:
+                del _password_cache[next(iter(_password_cache))]
+            _password_cache[key] = time.time() + PASSWORD_CACHE_TTL
+    return verified
+
+def needs_rehash(hashed_password):
+    # bcrypt hashes look like "$2b$NN$...", NN being the cost they were created with
+    if isinstance(hashed_password, bytes):
+        hashed_password = hashed_password.decode('utf-8')
+    parts = hashed_password.split("$")
+    return len(parts) < 3 or parts[2] != f"{BCRYPT_ROUNDS:02d}"
+
+# "$2a$", "$2b$" or "$2y$", a two digit cost, then 22 chars of salt + 31 of hash
+_BCRYPT_HASH_RE = re.compile(r"^\$2[aby]\$(0[4-9]|[12][0-9]|3[01])\$[./A-Za-z0-9]{53}$")
+
+def is_bcrypt_hash(value):
+    return bool(value) and _BCRYPT_HASH_RE.match(value) is not None
 
 def get_password_hash(password):
     if isinstance(password, str):
         password = password.encode('utf-8')
-    return bcrypt.hashpw(password, bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
+    # Numeric "exp" (seconds since epoch) avoids building datetime objects
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        expire = int(time.time()) + int(expires_delta.total_seconds())
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
+        expire = int(time.time()) + 15 * 60
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
@@ -43,20 +133,29 @@ async def get_current_user(request: Request, db: Session = Depends(database.get_
     token = request.cookies.get("access_token")
     if not token:
         return None
-    
-    # Remove "Bearer " prefix if present (it usually isn't in cookies but good practice)
-    if token.startswith("Bearer "):
-        token = token.split(" ")[1]
+
+    user_id = _get_cached_token(token)
+    if user_id is not None:
+        # A hit skips jwt.decode, but each request has a fresh session so this
+        # is still one primary key SELECT
+        return db.get(models.User, user_id)
 
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             return None
-    except JWTError:
+    except jwt.PyJWTError:
         return None
     
-    user = db.query(models.User).filter(models.User.username == username).first()
+    user_id = payload.get("uid")
+    if user_id is not None:
+        user = db.get(models.User, user_id)
+    else:
+        # Tokens issued before "uid" was added only carry the username
+        user = db.scalar(select(models.User).where(models.User.username == username))
+    if user and payload.get("exp") is not None:
+        _cache_token(token, float(payload["exp"]), user.id)
     return user
 
 # Dependency that RAISES error/redirects if not logged in
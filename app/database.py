@@ -4,9 +4,17 @@ from sqlalchemy.orm import sessionmaker
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./doc_rack.db"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# Every request opens a session, so size the pool for concurrent requests
+engine_options = {"pool_size": 20, "max_overflow": 40}
+if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    engine_options["connect_args"] = {"check_same_thread": False}
+else:
+    # Only server databases drop idle connections; for a local SQLite file
+    # pre-ping would just add a SELECT 1 to every checkout
+    engine_options["pool_pre_ping"] = True
+    engine_options["pool_recycle"] = 1800
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
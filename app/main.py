@@ -2,9 +2,13 @@ from fastapi import FastAPI, Request, Depends, Form, HTTPException, status
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.orm import Session, selectinload
 from datetime import timedelta
+import jinja2
 from . import models, database, auth
+from .database import get_db
 
 app = FastAPI()
 
@@ -13,24 +17,32 @@ app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
 # Templates
 templates = Jinja2Templates(directory="app/templates")
+# Templates only change on deploy: skip the mtime check on every render and
+# keep compiled templates in a bytecode cache (per-user temp dir) across restarts
+templates.env.auto_reload = False
+templates.env.bytecode_cache = jinja2.FileSystemBytecodeCache()
 
 # Init DB
 models.Base.metadata.create_all(bind=database.engine)
 
-def get_db():
-    db = database.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# create_all only builds indexes along with new tables, add missing ones to existing databases
+for table in models.Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=database.engine, checkfirst=True)
 
 # Startup event to create default admin if not exists
 @app.on_event("startup")
 def on_startup():
+    # Fail fast: a bad hash would be stored and make every admin login error out
+    if auth.DEFAULT_ADMIN_HASH and not auth.is_bcrypt_hash(auth.DEFAULT_ADMIN_HASH):
+        raise RuntimeError(
+            "DEFAULT_ADMIN_BCRYPT is not a valid bcrypt hash "
+            "(expected something like $2b$12$ followed by 53 characters)"
+        )
     db = database.SessionLocal()
     user = db.query(models.User).filter(models.User.username == "admin").first()
     if not user:
-        hashed_password = auth.get_password_hash("admin")
+        hashed_password = auth.DEFAULT_ADMIN_HASH or auth.get_password_hash("admin")
         user = models.User(username="admin", hashed_password=hashed_password)
         db.add(user)
         db.commit()
@@ -45,16 +57,34 @@ async def login_page(request: Request):
 @app.post("/login")
 async def login(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.username == username).first()
-    if not user or not auth.verify_password(password, user.hashed_password):
+    # Always run bcrypt (against a dummy hash for unknown users) and combine
+    # the results without short-circuiting to avoid user enumeration by timing
+    # bcrypt is CPU bound, run it in the threadpool so the event loop is not blocked
+    verified = await run_in_threadpool(auth.verify_password, password, user.hashed_password if user else auth.DUMMY_HASH)
+    ok = int(user is not None) & int(verified)
+    if not ok:
         return templates.TemplateResponse("login.html", {"request": request, "error": "Usuário ou senha inválidos"})
     
+    # Move the stored hash to the configured cost, otherwise accounts hashed with
+    # another cost answer slower/faster than the dummy hash used for unknown users
+    if auth.needs_rehash(user.hashed_password):
+        user.hashed_password = await run_in_threadpool(auth.get_password_hash, password)
+        db.commit()
+    
     access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = auth.create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={"sub": user.username, "uid": user.id}, expires_delta=access_token_expires
     )
     
     response = RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
-    response.set_cookie(key="access_token", value=f"Bearer {access_token}", httponly=True)
+    response.set_cookie(
+        key="access_token",
+        value=access_token,
+        max_age=int(access_token_expires.total_seconds()),
+        httponly=True,
+        secure=auth.COOKIE_SECURE,
+        samesite="lax",
+    )
     return response
 
 @app.get("/logout")
@@ -67,7 +97,8 @@ async def logout(request: Request):
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request, db: Session = Depends(get_db), user: models.User = Depends(auth.get_current_user_required)):
-    racks = db.query(models.Rack).all()
+    # The dashboard shows a device count per rack, load all devices in one query
+    racks = db.scalars(select(models.Rack).options(selectinload(models.Rack.devices))).all()
     return templates.TemplateResponse("index.html", {"request": request, "racks": racks, "user": user})
 
 @app.post("/racks/add")
@@ -77,15 +108,33 @@ async def add_rack(name: str = Form(...), location: str = Form(...), height: int
     db.commit()
     return RedirectResponse(url="/", status_code=303)
 
+# Delete matching devices and their ports with set based statements, clearing
+# connections that point at those ports first so none is left dangling
+def delete_devices(db: Session, *criteria):
+    device_ids = select(models.Device.id).where(*criteria)
+    port_ids = select(models.Port.id).where(models.Port.device_id.in_(device_ids))
+    db.execute(
+        update(models.Port)
+        .where(models.Port.connected_to_id.in_(port_ids))
+        .values(connected_to_id=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(
+        delete(models.Port)
+        .where(models.Port.device_id.in_(device_ids))
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(
+        delete(models.Device)
+        .where(*criteria)
+        .execution_options(synchronize_session=False)
+    )
+
 @app.post("/racks/{rack_id}/delete")
 async def delete_rack(rack_id: int, db: Session = Depends(get_db), user: models.User = Depends(auth.get_current_user_required)):
-    rack = db.query(models.Rack).filter(models.Rack.id == rack_id).first()
-    if rack:
-        # Devices and ports cascade delete usually needs to be configured in models or handled manually
-        # SQLAlchemy cascade="all, delete-orphan" on relationship usually handles it if configured
-        # Let's check models.py later, but for now manual cleanup is safer if not sure
-        db.delete(rack)
-        db.commit()
+    delete_devices(db, models.Device.rack_id == rack_id)
+    db.execute(delete(models.Rack).where(models.Rack.id == rack_id))
+    db.commit()
     return RedirectResponse(url="/", status_code=303)
 
 @app.get("/profile", response_class=HTMLResponse)
@@ -101,7 +150,7 @@ async def change_password(
     db: Session = Depends(get_db),
     user: models.User = Depends(auth.get_current_user_required)
 ):
-    if not auth.verify_password(current_password, user.hashed_password):
+    if not await run_in_threadpool(auth.verify_password, current_password, user.hashed_password):
         return templates.TemplateResponse("profile.html", {
             "request": request, 
             "user": user, 
@@ -119,7 +168,7 @@ async def change_password(
     # This prevents issues where the injected user object might be detached
     db_user = db.query(models.User).filter(models.User.id == user.id).first()
     if db_user:
-        db_user.hashed_password = auth.get_password_hash(new_password)
+        db_user.hashed_password = await run_in_threadpool(auth.get_password_hash, new_password)
         db.add(db_user)
         db.commit()
         db.refresh(db_user)
@@ -130,32 +179,23 @@ async def change_password(
         "message": "Senha alterada com sucesso!"
     })
 
-@app.get("/racks/{rack_id}", response_class=HTMLResponse)
-async def view_rack(request: Request, rack_id: int, db: Session = Depends(get_db), user: models.User = Depends(auth.get_current_user_required)):
-    rack = db.query(models.Rack).filter(models.Rack.id == rack_id).first()
-    if not rack:
-        raise HTTPException(status_code=404, detail="Rack not found")
-    
+# Build the U by U slot list (device start or empty U) from the top of the rack down to 1
+def build_rack_visual(devices, rack_height):
     # Sort devices by U position (descending for visual rack view)
-    devices = sorted(rack.devices, key=lambda x: x.u_position, reverse=True)
-    
-    # Create a visual grid representation
-    # We need to map which U is occupied by which device
-    u_slots = []
-    occupied_u = set()
-    
-    for device in devices:
-        for u in range(device.u_position, device.u_position + device.u_height):
-            occupied_u.add(u)
+    devices = sorted(devices, key=lambda x: x.u_position, reverse=True)
+
+    # Map the top U of each device to the device (first in sort order wins on overlaps)
+    # and mark every occupied U in a bitmap indexed by U number
+    starts = {d.u_position + d.u_height - 1: d for d in reversed(devices)}
+    occupied = bytearray(max(rack_height, 0) + 1)
+    for d in devices:
+        for u in range(max(d.u_position, 1), min(d.u_position + d.u_height, rack_height + 1)):
+            occupied[u] = 1
 
-    # We want to iterate from Top (Height) to Bottom (1)
-    # We will pass a list of slots where each slot is either empty or the start of a device
-    # Or a placeholder for "occupied by device below"
-    
     rack_visual = []
-    current_u = rack.height
+    current_u = rack_height
     while current_u > 0:
-        device_at_this_u = next((d for d in devices if d.u_position + d.u_height - 1 == current_u), None)
+        device_at_this_u = starts.get(current_u)
         
         if device_at_this_u:
             rack_visual.append({
@@ -167,24 +207,29 @@ async def view_rack(request: Request, rack_id: int, db: Session = Depends(get_db
             })
             current_u -= device_at_this_u.u_height
         else:
-            # Check if this U is occupied by a device starting lower (shouldn't happen with the logic above, but for safety)
-            # Actually, the logic above jumps 'height' steps, so we just need to handle empty slots
-            is_occupied = False
-            for d in devices:
-                if d.u_position <= current_u < d.u_position + d.u_height:
-                    is_occupied = True
-                    break
-            
-            if not is_occupied:
+            # Occupied slots without a device start only happen with overlaps/errors
+            if not occupied[current_u]:
                 rack_visual.append({
                     "u": current_u,
                     "type": "empty",
                     "height": 1
                 })
-                current_u -= 1
-            else:
-                 # Should have been caught by the jump, but if we have overlaps/errors
-                 current_u -= 1
+            current_u -= 1
+
+    return rack_visual
+
+@app.get("/racks/{rack_id}", response_class=HTMLResponse)
+async def view_rack(request: Request, rack_id: int, db: Session = Depends(get_db), user: models.User = Depends(auth.get_current_user_required)):
+    # Devices and their ports are read by the template, load them up front
+    rack = db.scalar(
+        select(models.Rack)
+        .options(selectinload(models.Rack.devices).selectinload(models.Device.ports))
+        .where(models.Rack.id == rack_id)
+    )
+    if not rack:
+        raise HTTPException(status_code=404, detail="Rack not found")
+    
+    rack_visual = build_rack_visual(rack.devices, rack.height)
 
     return templates.TemplateResponse("rack_detail.html", {
         "request": request, 
@@ -218,17 +263,33 @@ async def add_device(
 
 @app.post("/devices/{device_id}/delete")
 async def delete_device(device_id: int, db: Session = Depends(get_db), user: models.User = Depends(auth.get_current_user_required)):
-    device = db.query(models.Device).filter(models.Device.id == device_id).first()
-    rack_id = device.rack_id
-    if device:
-        db.delete(device)
-        db.commit()
+    rack_id = db.scalar(select(models.Device.rack_id).where(models.Device.id == device_id))
+    if rack_id is None:
+        return RedirectResponse(url="/", status_code=303)
+    delete_devices(db, models.Device.id == device_id)
+    db.commit()
     return RedirectResponse(url=f"/racks/{rack_id}", status_code=303)
 
 @app.get("/devices/{device_id}", response_class=HTMLResponse)
 async def view_device(request: Request, device_id: int, db: Session = Depends(get_db), user: models.User = Depends(auth.get_current_user_required)):
-    device = db.query(models.Device).filter(models.Device.id == device_id).first()
-    all_devices = db.query(models.Device).all() # For connection dropdowns
+    # The template walks every port and its connected port's device and rack
+    device = db.scalar(
+        select(models.Device)
+        .options(
+            selectinload(models.Device.rack),
+            selectinload(models.Device.ports)
+            .joinedload(models.Port.connected_to)
+            .joinedload(models.Port.device)
+            .joinedload(models.Device.rack),
+        )
+        .where(models.Device.id == device_id)
+    )
+    all_devices = db.scalars(
+        select(models.Device).options(
+            selectinload(models.Device.rack),
+            selectinload(models.Device.ports).joinedload(models.Port.connected_to),
+        )
+    ).all() # For connection dropdowns
     
     # Flatten ports for connection targets
     # (In a real app, we'd filter compatible ports, etc.)
@@ -243,11 +304,11 @@ async def view_device(request: Request, device_id: int, db: Session = Depends(ge
 async def add_port(device_id: int, name: str = Form(...), db: Session = Depends(get_db), user: models.User = Depends(auth.get_current_user_required)):
     # Supports comma separated names e.g. "1,2,3" or "Gi1/0/1"
     port_names = [n.strip() for n in name.split(',')]
-    for p_name in port_names:
-        if p_name:
-            new_port = models.Port(name=p_name, device_id=device_id)
-            db.add(new_port)
-    db.commit()
+    mappings = [{"name": p_name, "device_id": device_id} for p_name in port_names if p_name]
+    # One executemany INSERT, skipping per-object ORM overhead
+    if mappings:
+        db.execute(insert(models.Port), mappings)
+        db.commit()
     return RedirectResponse(url=f"/devices/{device_id}", status_code=303)
 
 @app.post("/ports/{port_id}/connect")
@@ -264,11 +325,19 @@ async def connect_port(port_id: int, target_port_id: int = Form(...), db: Sessio
 
 @app.post("/ports/{port_id}/disconnect")
 async def disconnect_port(port_id: int, db: Session = Depends(get_db), user: models.User = Depends(auth.get_current_user_required)):
-    port = db.query(models.Port).filter(models.Port.id == port_id).first()
-    if port and port.connected_to:
-        target = port.connected_to
-        target.connected_to_id = None
-        port.connected_to_id = None
+    row = db.execute(
+        select(models.Port.connected_to_id, models.Port.device_id).where(models.Port.id == port_id)
+    ).one_or_none()
+    if row is None:
+        return RedirectResponse(url="/", status_code=303)
+    if row.connected_to_id is not None:
+        # Clear both ends of the connection in a single UPDATE
+        db.execute(
+            update(models.Port)
+            .where(models.Port.id.in_([port_id, row.connected_to_id]))
+            .values(connected_to_id=None)
+            .execution_options(synchronize_session=False)
+        )
         db.commit()
         
-    return RedirectResponse(url=f"/devices/{port.device_id}", status_code=303)
+    return RedirectResponse(url=f"/devices/{row.device_id}", status_code=303)
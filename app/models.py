@@ -28,7 +28,7 @@ class Device(Base):
     u_position = Column(Integer) # The bottom U number
     u_height = Column(Integer, default=1) # Height in U
     
-    rack_id = Column(Integer, ForeignKey("racks.id"))
+    rack_id = Column(Integer, ForeignKey("racks.id", ondelete="CASCADE"), index=True)
     rack = relationship("Rack", back_populates="devices")
     
     ports = relationship("Port", back_populates="device", cascade="all, delete-orphan")
@@ -38,10 +38,10 @@ class Port(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String) # e.g., "Eth1/1", "Gi0/1"
-    device_id = Column(Integer, ForeignKey("devices.id"))
+    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), index=True)
     
     device = relationship("Device", back_populates="ports")
     
     # Simple adjacency list for connections
-    connected_to_id = Column(Integer, ForeignKey("ports.id"), nullable=True)
+    connected_to_id = Column(Integer, ForeignKey("ports.id", ondelete="SET NULL"), nullable=True, index=True)
     connected_to = relationship("Port", remote_side=[id], backref="connected_from")